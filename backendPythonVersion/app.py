@@ -9,7 +9,7 @@ import time
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 from scraper import scrape_all_products, load_products, get_all_terpenes
-from db import init_db
+from db import init_db, get_catalog_version, load_changes
 
 REFRESH_INTERVAL_SECONDS = 60 * 60  # 1 hour
 
@@ -23,7 +23,7 @@ def _auto_refresh_loop():
     while True:
         print("[auto-refresh] Starting product refresh...")
         try:
-            products = scrape_all_products()
+            products, _ = scrape_all_products()
             print(f"[auto-refresh] Done — {len(products)} products updated.")
         except Exception as e:
             print(f"[auto-refresh] Error during refresh: {e}")
@@ -48,7 +48,12 @@ def get_products():
     - min_thc: Minimum THC percentage
     - max_thc: Maximum THC percentage
     - purchase_type: Filter by purchase type ('Recreational' or 'Medical')
+
+    The response includes the catalog ``version`` the data is at least as
+    new as, for use with /api/changes.
     """
+    version = get_catalog_version()
+
     # SQL-level filters (efficient)
     sql_filters = {
         'purchase_type': request.args.get('purchase_type'),
@@ -97,10 +102,59 @@ def get_products():
 
     return jsonify({
         'products': products,
-        'total': len(products)
+        'total': len(products),
+        'version': version
     })
 
 
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """
+    Get only the products changed since a catalog version.
+
+    Query parameters:
+    - since: Catalog version the client last synced to
+
+    Changes are compacted to the latest state per variant. If ``since`` is
+    missing, unknown, or older than the retention window, the full catalog
+    is returned with ``full_resync: true`` instead. A non-integer ``since``
+    is rejected with 400.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'since must be an integer catalog version'
+            }), 400
+    try:
+        changes = load_changes(since) if since is not None else None
+        if changes is None:
+            version = get_catalog_version(raise_errors=True)
+            products = load_products(raise_errors=True)
+            return jsonify({
+                'full_resync': True,
+                'version': version,
+                'products': products,
+                'total': len(products)
+            })
+        return jsonify({
+            'full_resync': False,
+            'since': since,
+            'version': changes['version'],
+            'upserted': changes['upserted'],
+            'deleted': changes['deleted'],
+            'total_changes': len(changes['upserted']) + len(changes['deleted'])
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @app.route('/api/refresh', methods=['GET', 'POST'])
 def refresh_products():
     """
@@ -108,12 +162,13 @@ def refresh_products():
     Returns the newly scraped products.
     """
     try:
-        products = scrape_all_products()
+        products, version = scrape_all_products()
         return jsonify({
             'success': True,
             'message': f'Successfully scraped {len(products)} products',
             'products': products,
-            'total': len(products)
+            'total': len(products),
+            'version': version
         })
     except Exception as e:
         return jsonify({
@@ -219,6 +274,7 @@ if __name__ == '__main__':
     print("API available at http://localhost:5001")
     print("\nEndpoints:")
     print("  GET /api/products   - Get all products (with optional filtering/sorting)")
+    print("  GET /api/changes    - Get products changed since a catalog version")
     print("  GET /api/refresh    - Trigger a fresh scrape")
     print("  GET /api/terpenes   - List all available terpenes")
     print("  GET /api/categories - List all categories")
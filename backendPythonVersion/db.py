@@ -5,6 +5,7 @@ Handles connection, schema initialisation, upserts, and loading.
 
 import json
 import os
+from contextlib import contextmanager
 
 import psycopg2
 import psycopg2.extras
@@ -14,13 +15,38 @@ DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql://localhost/terpene_so
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# How long to keep change events. Clients asking for a delta older than this
+# get a full resync instead.
+CHANGE_RETENTION_DAYS = 7
+
+# pg_advisory_xact_lock key serialising catalog refreshes across processes
+_CATALOG_LOCK_ID = 0x7e59
+
+_PRODUCT_COLUMNS = """
+    variant_id,
+    name,
+    brand,
+    category,
+    strain_type,
+    CAST(price          AS FLOAT) AS price,
+    CAST(sale_price     AS FLOAT) AS sale_price,
+    weight,
+    CAST(thc            AS FLOAT) AS thc,
+    CAST(cbd            AS FLOAT) AS cbd,
+    image,
+    url,
+    terpenes,
+    CAST(total_terpenes AS FLOAT) AS total_terpenes,
+    purchase_type
+"""
+
 
 def get_connection():
     return psycopg2.connect(DATABASE_URL)
 
 
 def init_db():
-    """Create the products table if it doesn't exist yet."""
+    """Create the products and change-feed tables if they don't exist yet."""
     ddl = """
     CREATE TABLE IF NOT EXISTS products (
         variant_id      INTEGER PRIMARY KEY,
@@ -48,13 +74,90 @@ def init_db():
                 ALTER TABLE products
                 ADD COLUMN IF NOT EXISTS purchase_type TEXT NOT NULL DEFAULT '';
             """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS catalog_versions (
+                    version     BIGSERIAL    PRIMARY KEY,
+                    created_at  TIMESTAMPTZ  NOT NULL DEFAULT NOW()
+                );
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS product_changes (
+                    version     BIGINT   NOT NULL,
+                    variant_id  INTEGER  NOT NULL,
+                    op          TEXT     NOT NULL CHECK (op IN ('upsert', 'delete')),
+                    PRIMARY KEY (version, variant_id)
+                );
+            """)
         conn.commit()
 
 
-def save_products(products):
+@contextmanager
+def catalog_version():
+    """Open a refresh transaction and yield ``(cur, version)``.
+
+    A new catalog version is allocated under a cross-process advisory lock,
+    so versions become visible strictly in order. Pass ``cur`` and
+    ``version`` to ``save_products`` and ``delete_stale_products``; all
+    writes and change events commit together with the version, or not at
+    all if the block raises. Change events past retention are pruned.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_CATALOG_LOCK_ID,))
+            cur.execute("INSERT INTO catalog_versions DEFAULT VALUES RETURNING version")
+            version = cur.fetchone()[0]
+
+            yield cur, version
+
+            cur.execute(
+                "DELETE FROM catalog_versions WHERE created_at < NOW() - make_interval(days => %s)",
+                (CHANGE_RETENTION_DAYS,)
+            )
+            cur.execute("""
+                DELETE FROM product_changes
+                WHERE version < (SELECT MIN(version) FROM catalog_versions)
+            """)
+        conn.commit()
+
+
+def get_catalog_version(raise_errors=False):
+    """Return the latest committed catalog version (0 if none yet).
+
+    Errors are logged and reported as version 0 unless ``raise_errors``.
+    """
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM catalog_versions")
+                return cur.fetchone()[0]
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"get_catalog_version error: {e}")
+        return 0
+
+
+def _record_changes(cur, version, variant_ids, op):
+    """Write one change event per variant_id under ``version`` (latest op wins)."""
+    if not variant_ids:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO product_changes (version, variant_id, op) VALUES %s
+        ON CONFLICT (version, variant_id) DO UPDATE SET op = EXCLUDED.op
+        """,
+        [(version, variant_id, op) for variant_id in variant_ids],
+    )
+
+
+def save_products(products, cur=None, version=None):
     """Bulk-upsert products into the database.
 
-    Rows without both ``name`` and ``variant_id`` are skipped.
+    Rows without both ``name`` and ``variant_id`` are skipped. Rows whose
+    data is unchanged are left untouched. With ``cur`` and ``version`` from
+    ``catalog_version()``, the upsert runs in that transaction and an
+    ``upsert`` change event is recorded for every inserted or modified row.
     """
     valid = [p for p in products if p.get("name") and p.get("variant_id")]
     if not valid:
@@ -104,38 +207,69 @@ def save_products(products):
         total_terpenes = EXCLUDED.total_terpenes,
         purchase_type  = EXCLUDED.purchase_type,
         updated_at     = NOW()
+    WHERE (
+        products.name, products.brand, products.category, products.strain_type,
+        products.price, products.sale_price, products.weight, products.thc, products.cbd,
+        products.image, products.url, products.terpenes, products.total_terpenes,
+        products.purchase_type
+    ) IS DISTINCT FROM (
+        EXCLUDED.name, EXCLUDED.brand, EXCLUDED.category, EXCLUDED.strain_type,
+        EXCLUDED.price, EXCLUDED.sale_price, EXCLUDED.weight, EXCLUDED.thc, EXCLUDED.cbd,
+        EXCLUDED.image, EXCLUDED.url, EXCLUDED.terpenes, EXCLUDED.total_terpenes,
+        EXCLUDED.purchase_type
+    )
+    RETURNING variant_id
     """
 
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            psycopg2.extras.execute_values(cur, sql, rows)
-        conn.commit()
+    if cur is None:
+        with get_connection() as conn:
+            with conn.cursor() as own_cur:
+                changed = psycopg2.extras.execute_values(own_cur, sql, rows, fetch=True)
+            conn.commit()
+    else:
+        changed = psycopg2.extras.execute_values(cur, sql, rows, fetch=True)
+        if version is not None:
+            _record_changes(cur, version, [row[0] for row in changed], 'upsert')
+
+    print(
+        f"Upserted {len(valid)} products into PostgreSQL "
+        f"({len(changed)} changed, {len(products) - len(valid)} skipped)"
+    )
 
-    print(f"Upserted {len(valid)} products into PostgreSQL ({len(products) - len(valid)} skipped)")
 
+def delete_stale_products(current_variant_ids, cur=None, version=None):
+    """Delete any products whose variant_id is not in current_variant_ids.
 
-def delete_stale_products(current_variant_ids):
-    """Delete any products whose variant_id is not in current_variant_ids."""
+    With ``cur`` and ``version`` from ``catalog_version()``, the delete runs
+    in that transaction and a ``delete`` change event is recorded for every
+    removed row.
+    """
     if not current_variant_ids:
         print("delete_stale_products: empty id set, skipping to avoid wiping all products")
         return
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "DELETE FROM products WHERE variant_id != ALL(%s)",
-                (list(current_variant_ids),)
-            )
-            deleted = cur.rowcount
-        conn.commit()
+    sql = "DELETE FROM products WHERE variant_id != ALL(%s) RETURNING variant_id"
+    if cur is None:
+        with get_connection() as conn:
+            with conn.cursor() as own_cur:
+                own_cur.execute(sql, (list(current_variant_ids),))
+                deleted_ids = [row[0] for row in own_cur.fetchall()]
+            conn.commit()
+    else:
+        cur.execute(sql, (list(current_variant_ids),))
+        deleted_ids = [row[0] for row in cur.fetchall()]
+        if version is not None:
+            _record_changes(cur, version, deleted_ids, 'delete')
+    deleted = len(deleted_ids)
     if deleted:
         print(f"Removed {deleted} stale product(s) no longer in the API")
 
 
-def load_products(filters=None):
+def load_products(filters=None, raise_errors=False):
     """Return products from the database as a list of plain dicts.
 
     Optional filters dict supports: purchase_type, category, strain_type,
     min_thc, max_thc. All string comparisons are case-insensitive.
+    Errors are logged and reported as an empty list unless ``raise_errors``.
     """
     where_clauses = []
     params = []
@@ -158,26 +292,61 @@ def load_products(filters=None):
         with get_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
                 cur.execute(f"""
-                    SELECT
-                        variant_id,
-                        name,
-                        brand,
-                        category,
-                        strain_type,
-                        CAST(price          AS FLOAT) AS price,
-                        CAST(sale_price     AS FLOAT) AS sale_price,
-                        weight,
-                        CAST(thc            AS FLOAT) AS thc,
-                        CAST(cbd            AS FLOAT) AS cbd,
-                        image,
-                        url,
-                        terpenes,
-                        CAST(total_terpenes AS FLOAT) AS total_terpenes,
-                        purchase_type
+                    SELECT {_PRODUCT_COLUMNS}
                     FROM products
                     {where}
                 """, params or None)
                 return [dict(row) for row in cur.fetchall()]
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"load_products error: {e}")
         return []
+
+
+def load_changes(since):
+    """Return the compacted delta between catalog version ``since`` and now.
+
+    The result is a dict with ``version`` (the version to pass as ``since``
+    next time), ``upserted`` (current rows for every variant whose latest
+    change is an upsert) and ``deleted`` (variant_ids whose latest change is
+    a delete). Returns ``None`` when ``since`` is unknown or older than the
+    retained change window, in which case the caller must do a full resync.
+
+    Everything is read from one REPEATABLE READ snapshot so the bounds,
+    events and rows agree even while a refresh commits or prunes.
+    """
+    with get_connection() as conn:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                SELECT
+                    COALESCE(MAX(version), 0)     AS current,
+                    COALESCE(MIN(version), 1) - 1 AS floor
+                FROM catalog_versions
+            """)
+            bounds = cur.fetchone()
+            current, floor = bounds['current'], bounds['floor']
+            if since <= 0 or since < floor or since > current:
+                return None
+
+            cur.execute("""
+                SELECT DISTINCT ON (variant_id) variant_id, op
+                FROM product_changes
+                WHERE version > %s AND version <= %s
+                ORDER BY variant_id, version DESC
+            """, (since, current))
+            latest = cur.fetchall()
+
+            deleted = [row['variant_id'] for row in latest if row['op'] == 'delete']
+            upsert_ids = [row['variant_id'] for row in latest if row['op'] == 'upsert']
+            upserted = []
+            if upsert_ids:
+                cur.execute(f"""
+                    SELECT {_PRODUCT_COLUMNS}
+                    FROM products
+                    WHERE variant_id = ANY(%s)
+                """, (upsert_ids,))
+                upserted = [dict(row) for row in cur.fetchall()]
+
+    return {'version': current, 'upserted': upserted, 'deleted': deleted}
@@ -10,7 +10,13 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
-from db import init_db, save_products as db_save_products, load_products as db_load_products, delete_stale_products
+from db import (
+    init_db,
+    save_products as db_save_products,
+    load_products as db_load_products,
+    delete_stale_products,
+    catalog_version,
+)
 
 BASE_URL = "https://shop.revcanna.com"
 LAB_API_URL = f"{BASE_URL}/_api/Products/GetExtendedLabdata"
@@ -177,7 +183,11 @@ def fetch_all_products_api():
 
 
 def scrape_all_products():
-    """Fetch all products from the API and enrich each with lab terpene data."""
+    """Fetch all products from the API and enrich each with lab terpene data.
+
+    Each run writes its rows and change events under a new catalog version
+    in a single transaction. Returns ``(products, version)``.
+    """
     init_db()
     print("Fetching all products from SweedPOS API...")
     all_products = fetch_all_products_api()
@@ -213,20 +223,22 @@ def scrape_all_products():
             if completed % 50 == 0 or completed == len(all_products):
                 print(f"  {completed}/{len(all_products)} variants enriched")
 
-    save_products(all_products)
     current_ids = {p['variant_id'] for p in all_products if p.get('variant_id')}
-    delete_stale_products(current_ids)
-    return all_products
+    with catalog_version() as (cur, version):
+        save_products(all_products, cur=cur, version=version)
+        delete_stale_products(current_ids, cur=cur, version=version)
+    print(f"Published catalog version {version}")
+    return all_products, version
 
 
-def save_products(products):
+def save_products(products, cur=None, version=None):
     """Upsert products into PostgreSQL."""
-    db_save_products(products)
+    db_save_products(products, cur=cur, version=version)
 
 
-def load_products(filters=None):
+def load_products(filters=None, raise_errors=False):
     """Load products from PostgreSQL."""
-    return db_load_products(filters=filters)
+    return db_load_products(filters=filters, raise_errors=raise_errors)
 
 
 def get_all_terpenes():
@@ -239,7 +251,7 @@ def get_all_terpenes():
 
 
 if __name__ == "__main__":
-    products = scrape_all_products()
+    products, _ = scrape_all_products()
     print(f"\nScraped {len(products)} products")
     if products:
         print("\nSample product:")